@@ -1,16 +1,17 @@
 import streamlit as st
 import numpy as np
-import easyocr
 from PIL import Image
 import openai
 import smtplib
 import ssl
 from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 from datetime import datetime, timedelta
 import time
+import threading
 import base64
 import json
+import io
+import hashlib
 
 # Mobile-optimized page configuration
 st.set_page_config(
@@ -24,9 +25,50 @@ st.set_page_config(
 OPENAI_API_KEY = st.secrets["OPENAI_API_KEY"]
 GMAIL_EMAIL = st.secrets["GMAIL_EMAIL"]
 GMAIL_APP_PASSWORD = st.secrets["GMAIL_APP_PASSWORD"]
+OPENAI_MODEL = st.secrets.get("OPENAI_MODEL", "gpt-5-mini")
+
+@st.cache_resource
+def get_openai_client():
+    """One OpenAI client per process so its HTTP connection pool survives reruns"""
+    return openai.OpenAI(
+        api_key=OPENAI_API_KEY,
+        max_retries=0  # retries are handled by with_retry()
+    )
 
-openai.api_key = OPENAI_API_KEY
-reader = easyocr.Reader(['en'])
+# No cache spinner: the warm-up thread has no script context to draw it in,
+# and uploads already wait inside the "Reading <file>..." spinner
+@st.cache_resource(show_spinner=False)
+def get_reader():
+    """Build the EasyOCR reader once per process and share it across reruns"""
+    # Imported here so torch/cv2 only load once a document is actually read
+    import easyocr
+    import torch
+    # Use CUDA when the host has it; on CPU, quantize=True (EasyOCR's
+    # default) runs the recognizer in int8
+    return easyocr.Reader(['en'], gpu=torch.cuda.is_available(), verbose=False, quantize=True)
+
+@st.cache_resource
+def start_reader_warmup():
+    """Load the OCR model on a background thread, once per process"""
+    # The page renders immediately; if a file is uploaded before the model is
+    # ready, get_reader() waits on the same cache entry instead of loading twice
+    thread = threading.Thread(target=get_reader, name="ocr-warmup", daemon=True)
+    thread.start()
+    return thread
+
+# OCR input resolution: PDFs are rasterized at this DPI and pages/images are
+# downscaled so their longest side fits, since the detector resizes anyway
+OCR_PDF_DPI = 150
+OCR_MAX_SIDE = 1600
+# PDF pages with at least this much embedded text skip OCR
+PDF_TEXT_MIN_CHARS = 20
+# Pages per batched detector pass (bounds peak memory on long PDFs)
+OCR_PAGE_BATCH = 8
+# Text crops per recognizer forward pass
+OCR_RECOG_BATCH = 8
+# Extracted report text is evicted from the process-wide cache after an hour
+OCR_CACHE_TTL = 3600  # seconds
+OCR_CACHE_MAX_ENTRIES = 32
 
 # Initialize session states
 if "conversation" not in st.session_state:
@@ -43,6 +85,14 @@ if "session_start" not in st.session_state:
     st.session_state.session_start = datetime.now()
 if "mobile_view" not in st.session_state:
     st.session_state.mobile_view = False
+if "ocr_files_key" not in st.session_state:
+    st.session_state.ocr_files_key = None
+if "pending_action" not in st.session_state:
+    st.session_state.pending_action = None
+if "report_context" not in st.session_state:
+    st.session_state.report_context = []
+if "report_cache_key" not in st.session_state:
+    st.session_state.report_cache_key = None
 
 # ========== MOBILE RESPONSIVE LAYOUT ==========
 def check_mobile_view():
@@ -64,7 +114,73 @@ def mobile_friendly_columns():
     else:
         return st.columns([1, 1])  # Two columns on desktop
 
+# ========== SMTP CONNECTION REUSE ==========
+# Gmail SMTP configuration
+SMTP_SERVER = "smtp.gmail.com"
+SMTP_PORT = 465  # implicit TLS: one handshake, no STARTTLS round trip
+
+@st.cache_resource
+def get_smtp_pool():
+    """Process-wide slot for one logged-in SMTP connection and its lock"""
+    return {"server": None, "lock": threading.Lock()}
+
+def smtp_connect():
+    """Open and authenticate a new TLS connection to Gmail SMTP"""
+    context = ssl.create_default_context()
+    server = smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT, context=context, timeout=30)
+    server.login(GMAIL_EMAIL, GMAIL_APP_PASSWORD)
+    return server
+
+def smtp_discard(server):
+    """Close a stale pooled connection, ignoring errors from a dead socket"""
+    try:
+        server.close()
+    except OSError:
+        pass
+
+def send_via_smtp(recipient, message):
+    """Send on the pooled connection, reconnecting if Gmail dropped it"""
+    pool = get_smtp_pool()
+    with pool["lock"]:
+        server = pool["server"]
+        if server is not None:
+            try:
+                alive = server.noop()[0] == 250
+            except (smtplib.SMTPException, OSError):
+                alive = False
+            if not alive:
+                smtp_discard(server)
+                server = pool["server"] = None
+        if server is None:
+            server = pool["server"] = smtp_connect()
+        
+        try:
+            server.sendmail(GMAIL_EMAIL, recipient, message.as_string())
+        except smtplib.SMTPServerDisconnected:
+            smtp_discard(server)
+            pool["server"] = None
+            server = pool["server"] = smtp_connect()
+            server.sendmail(GMAIL_EMAIL, recipient, message.as_string())
+
 # ========== ENHANCED EMAIL FORMATTING ==========
+EMAIL_MESSAGE_DIVIDER = "═" * 60 + "\n\n"
+
+EMAIL_PRIVACY_FOOTER = f"""
+🔒 PRIVACY & CONFIDENTIALITY
+{'='*60}
+• This conversation summary is for your personal records only
+• All data has been automatically cleared from our system
+• Please store this email securely
+• For medical emergencies, contact your healthcare provider immediately
+
+📞 Need Help?
+• Primary Doctor: [Your Doctor's Contact]
+• Emergency: 911 or your local emergency number
+• Mental Health Support: 988 Suicide & Crisis Lifeline
+
+Generated by AI Cancer Care Assistant
+"""
+
 def send_email_via_gmail():
     """Send conversation via Gmail SMTP with CLEAN vertical formatting"""
     if not st.session_state.user_email:
@@ -78,14 +194,11 @@ def send_email_via_gmail():
     
     try:
         with st.spinner("📧 Preparing and sending email..."):
-            # Gmail SMTP configuration
-            smtp_server = "smtp.gmail.com"
-            port = 587
             sender_email = GMAIL_EMAIL
-            sender_password = GMAIL_APP_PASSWORD
             
             # ENHANCED: Clean vertical email formatting
-            email_content = f"""
+            # Parts are collected and joined once instead of repeated +=
+            email_parts = [f"""
 CANCER CARE ASSISTANT - CONVERSATION SUMMARY
 ============================================
 
@@ -95,56 +208,38 @@ Total Messages: {len(st.session_state.conversation)}
 
 {'='*60}
 
-"""
+"""]
             
             for i, msg in enumerate(st.session_state.conversation):
                 if msg["role"] == "user":
-                    email_content += f"""
+                    email_parts.append(f"""
 YOU (Message {i+1}):
 {'-'*40}
 {msg['content']}
 
-"""
+""")
                 else:
-                    email_content += f"""
+                    email_parts.append(f"""
 AI ASSISTANT (Message {i+1}):
 {'-'*40}
 {msg['content']}
 
-"""
-                email_content += "═" * 60 + "\n\n"
+""")
+                email_parts.append(EMAIL_MESSAGE_DIVIDER)
             
-            # Enhanced privacy footer
-            email_content += f"""
-🔒 PRIVACY & CONFIDENTIALITY
-{'='*60}
-• This conversation summary is for your personal records only
-• All data has been automatically cleared from our system
-• Please store this email securely
-• For medical emergencies, contact your healthcare provider immediately
-
-📞 Need Help?
-• Primary Doctor: [Your Doctor's Contact]
-• Emergency: 911 or your local emergency number
-• Mental Health Support: 988 Suicide & Crisis Lifeline
-
-Generated by AI Cancer Care Assistant
-{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
-"""
+            # Enhanced privacy footer (static) plus the send timestamp
+            email_parts.append(EMAIL_PRIVACY_FOOTER)
+            email_parts.append(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+            email_content = "".join(email_parts)
             
-            # Create message
-            message = MIMEMultipart()
+            # Create message (plain text only, so no multipart wrapper)
+            message = MIMEText(email_content, "plain")
             message["From"] = f"Cancer Care Assistant <{sender_email}>"
             message["To"] = st.session_state.user_email
             message["Subject"] = f"Cancer Care Summary - {datetime.now().strftime('%Y-%m-%d')}"
-            message.attach(MIMEText(email_content, "plain"))
             
-            # Send email
-            context = ssl.create_default_context()
-            with smtplib.SMTP(smtp_server, port) as server:
-                server.starttls(context=context)
-                server.login(sender_email, sender_password)
-                server.sendmail(sender_email, st.session_state.user_email, message.as_string())
+            # Send email over the shared, already-authenticated connection
+            send_via_smtp(st.session_state.user_email, message)
         
         # SUCCESS NOTIFICATION with clear formatting
         st.success(f"""
@@ -199,33 +294,158 @@ def show_quick_stats():
             total_chars = sum(len(msg["content"]) for msg in st.session_state.conversation)
             st.metric("Conversation", f"~{total_chars // 1000}KB")
 
+@st.cache_resource
+def get_pdfium_lock():
+    """Process-wide lock serializing pdfium calls, which are not thread-safe"""
+    return threading.Lock()
+
+@st.cache_data(show_spinner=False, ttl=OCR_CACHE_TTL, max_entries=OCR_CACHE_MAX_ENTRIES)
+def ocr_file_bytes(content_hash, mime, _content):
+    """OCR an uploaded file, memoized on its content hash and mime type"""
+    if mime == "application/pdf":
+        import pypdfium2 as pdfium
+        # Sessions run on threads of one process, so every pdfium call holds
+        # the lock; it is released around OCR so other sessions can render
+        pdfium_lock = get_pdfium_lock()
+        # One in-process document serves both the text layer and rendering
+        with pdfium_lock:
+            pdf = pdfium.PdfDocument(_content)
+        try:
+            # Digital pages carry their own text; only scanned ones need OCR
+            with pdfium_lock:
+                page_texts = pdf_text_layer(pdf)
+            scanned = [i for i, text in enumerate(page_texts) if text is None]
+            
+            # Render and OCR one batch at a time, so peak memory is a batch
+            # of pages rather than the whole document
+            if scanned:
+                reader = get_reader()
+                for start in range(0, len(scanned), OCR_PAGE_BATCH):
+                    batch = scanned[start:start + OCR_PAGE_BATCH]
+                    with pdfium_lock:
+                        arrays = [render_page_array(pdf, i) for i in batch]
+                    for i, text in zip(batch, ocr_pages(reader, arrays)):
+                        page_texts[i] = text
+            return "\n".join(page_texts)
+        finally:
+            with pdfium_lock:
+                pdf.close()
+    
+    arrays = [to_ocr_array(Image.open(io.BytesIO(_content)))]
+    return "\n".join(ocr_pages(get_reader(), arrays))
+
+def render_page_array(pdf, index):
+    """Rasterize a PDF page in grayscale at OCR_PDF_DPI, capped at OCR_MAX_SIDE"""
+    # Caller holds the pdfium lock; handles are closed here rather than left
+    # to GC finalizers that could run on another thread
+    page = pdf[index]
+    try:
+        # PDF sizes are in points (1/72 in); render straight at the capped size
+        scale = min(OCR_PDF_DPI / 72, OCR_MAX_SIDE / max(page.get_size()))
+        bitmap = page.render(scale=scale, grayscale=True)
+        try:
+            # np.asarray copies the pixels, so the bitmap can be freed after
+            return to_ocr_array(bitmap.to_pil())
+        finally:
+            bitmap.close()
+    finally:
+        page.close()
+
+def pdf_text_layer(pdf):
+    """Embedded text per page, with None for pages that look scanned"""
+    # Caller holds the pdfium lock; pages and textpages are closed explicitly
+    page_texts = []
+    for index in range(len(pdf)):
+        page = pdf[index]
+        try:
+            textpage = page.get_textpage()
+            try:
+                text = textpage.get_text_range().replace("\r\n", "\n")
+            finally:
+                textpage.close()
+        finally:
+            page.close()
+        page_texts.append(text if len(text.strip()) >= PDF_TEXT_MIN_CHARS else None)
+    return page_texts
+
+def to_ocr_array(img):
+    """Downscaled RGB or grayscale uint8 array of a photo or rendered PDF page for OCR"""
+    # Convert only when needed; RGB photos and grayscale pages skip the copy
+    if img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    img.thumbnail((OCR_MAX_SIDE, OCR_MAX_SIDE), Image.LANCZOS)
+    arr = np.asarray(img)
+    return arr if arr.flags.c_contiguous else np.ascontiguousarray(arr)
+
+def ocr_pages(reader, arrays):
+    """OCR page arrays with batched detector passes over same-size pages"""
+    # readtext_batched stacks its inputs, so only equal shapes can share a batch
+    by_shape = {}
+    for idx, arr in enumerate(arrays):
+        by_shape.setdefault(arr.shape, []).append(idx)
+    
+    page_texts = [""] * len(arrays)
+    for indices in by_shape.values():
+        for start in range(0, len(indices), OCR_PAGE_BATCH):
+            batch = indices[start:start + OCR_PAGE_BATCH]
+            results = reader.readtext_batched(
+                [arrays[i] for i in batch],
+                detail=0,
+                batch_size=OCR_RECOG_BATCH
+            )
+            for i, words in zip(batch, results):
+                page_texts[i] = " ".join(words)
+    return page_texts
+
+def show_document_preview(uploaded_file, content, index):
+    """Mobile-optimized image display (PDFs have no inline preview)"""
+    is_pdf = uploaded_file.type == "application/pdf"
+    if st.session_state.mobile_view:
+        if is_pdf:
+            st.caption(f"📄 {uploaded_file.name} (PDF)")
+        else:
+            st.image(content, caption=uploaded_file.name, use_column_width=True)
+    else:
+        with st.expander(f"📄 {uploaded_file.name}", expanded=(index==0)):
+            if is_pdf:
+                st.caption("PDF document")
+            else:
+                st.image(content, use_column_width=True)
+
 def enhanced_document_processor(uploaded_files):
     """Enhanced document processing with mobile support"""
     if not uploaded_files:
         return
     
+    # Same file set as the last completed run: keep its OCR text and
+    # skip the progress UI entirely. file_id is unique per upload, so a
+    # replacement with the same name and size is still read
+    files_key = tuple(f.file_id for f in uploaded_files)
+    if st.session_state.ocr_files_key == files_key:
+        for i, uploaded_file in enumerate(uploaded_files):
+            show_document_preview(uploaded_file, uploaded_file.getvalue(), i)
+        return
+    
     # Progress tracking
     progress_bar = st.progress(0)
     status_text = st.empty()
     
     st.session_state.ocr_text = ""
+    all_read = True
     
     for i, uploaded_file in enumerate(uploaded_files):
         status_text.text(f"📄 {i+1}/{len(uploaded_files)}: {uploaded_file.name}")
         
         try:
-            img = Image.open(uploaded_file)
+            # Read the upload once; reruns hit the OCR cache by content hash
+            content = uploaded_file.getvalue()
             
-            # Mobile-optimized image display
-            if st.session_state.mobile_view:
-                st.image(img, caption=uploaded_file.name, use_column_width=True)
-            else:
-                with st.expander(f"📄 {uploaded_file.name}", expanded=(i==0)):
-                    st.image(img, use_column_width=True)
+            show_document_preview(uploaded_file, content, i)
             
             # OCR processing
             with st.spinner(f"Reading {uploaded_file.name}..."):
-                extracted_text = " ".join(reader.readtext(np.array(img), detail=0))
+                content_hash = hashlib.blake2b(content, digest_size=16).hexdigest()
+                extracted_text = ocr_file_bytes(content_hash, uploaded_file.type, content)
                 st.session_state.ocr_text += extracted_text + "\n\n"
                 
                 if extracted_text.strip():
@@ -235,10 +455,15 @@ def enhanced_document_processor(uploaded_files):
         
         except Exception as e:
             st.error(f"❌ {uploaded_file.name}: {e}")
+            all_read = False
         
         progress_bar.progress((i + 1) / len(uploaded_files))
         time.sleep(0.3)
     
+    # Failed files are retried on the next rerun
+    if all_read:
+        st.session_state.ocr_files_key = files_key
+    
     status_text.text("✅ Documents ready!")
     time.sleep(1)
     status_text.empty()
@@ -246,6 +471,9 @@ def enhanced_document_processor(uploaded_files):
 
 # ========== MOBILE-OPTIMIZED MAIN LAYOUT ==========
 def main():
+    # Start loading the OCR model while the user picks files
+    start_reader_warmup()
+    
     # Check and apply mobile settings
     check_mobile_view()
     
@@ -273,22 +501,7 @@ def mobile_single_column_layout():
     """Single column layout for mobile devices"""
     
     # Document Upload Section
-    st.subheader("📁 Upload Documents")
-    uploaded_files = st.file_uploader(
-        "Choose medical files:",
-        type=['pdf','png','jpg','jpeg'],
-        accept_multiple_files=True,
-        help="Lab reports, diagnosis, medical images"
-    )
-    
-    if uploaded_files:
-        enhanced_document_processor(uploaded_files)
-        
-        if st.button("🎯 Generate Analysis", type="primary", use_container_width=True):
-            if st.session_state.ocr_text.strip():
-                generate_analysis()
-            else:
-                st.warning("Please upload readable documents first")
+    render_upload_section()
     
     st.markdown("---")
     
@@ -306,22 +519,7 @@ def desktop_two_column_layout():
     left_col, right_col = st.columns([1, 1])
     
     with left_col:
-        st.subheader("📁 Upload Documents")
-        uploaded_files = st.file_uploader(
-            "Choose medical files:",
-            type=['pdf','png','jpg','jpeg'],
-            accept_multiple_files=True,
-            help="Lab reports, diagnosis, medical images"
-        )
-        
-        if uploaded_files:
-            enhanced_document_processor(uploaded_files)
-            
-            if st.button("🎯 Generate Analysis", type="primary", use_container_width=True):
-                if st.session_state.ocr_text.strip():
-                    generate_analysis()
-                else:
-                    st.warning("Please upload readable documents first")
+        render_upload_section()
     
     with right_col:
         st.subheader("💬 Consultation")
@@ -331,6 +529,26 @@ def desktop_two_column_layout():
             st.markdown("---")
             show_quick_stats()
 
+def render_upload_section():
+    """Upload widget, OCR and Generate button shared by both layouts"""
+    st.subheader("📁 Upload Documents")
+    uploaded_files = st.file_uploader(
+        "Choose medical files:",
+        type=['pdf','png','jpg','jpeg'],
+        accept_multiple_files=True,
+        help="Lab reports, diagnosis, medical images"
+    )
+    
+    if uploaded_files:
+        enhanced_document_processor(uploaded_files)
+        
+        if st.button("🎯 Generate Analysis", type="primary", use_container_width=True):
+            if st.session_state.ocr_text.strip():
+                # Streamed into the Consultation container, rendered later this run
+                st.session_state.pending_action = ("analysis", None)
+            else:
+                st.warning("Please upload readable documents first")
+
 def render_chat_interface():
     """Render chat interface for both mobile and desktop"""
     chat_container = st.container()
@@ -352,48 +570,65 @@ def render_chat_interface():
                         if st.session_state.mobile_view:
                             # Single column buttons for mobile
                             for idx, question in enumerate(SUGGESTED_QUESTIONS):
-                                if st.button(f"❓ {question}", key=f"mq_{idx}", use_container_width=True):
-                                    handle_suggested_question(question)
+                                st.button(f"❓ {question}", key=f"mq_{idx}", use_container_width=True,
+                                          on_click=handle_suggested_question, args=(question,))
                         else:
                             # Two columns for desktop
                             col1, col2 = st.columns(2)
                             for idx, question in enumerate(SUGGESTED_QUESTIONS):
                                 col = col1 if idx % 2 == 0 else col2
                                 with col:
-                                    if st.button(f"❓ {question}", key=f"q_{idx}", use_container_width=True):
-                                        handle_suggested_question(question)
+                                    st.button(f"❓ {question}", key=f"q_{idx}", use_container_width=True,
+                                              on_click=handle_suggested_question, args=(question,))
     
     # Chat input
     if st.session_state.processing_complete:
         st.markdown("---")
         user_input = st.chat_input("Type your question here...")
         if user_input:
-            handle_user_message(user_input)
+            st.session_state.pending_action = ("question", user_input)
+    
+    # Run the queued action after the history, so its reply streams in place
+    # below the last message rather than wherever the click was handled
+    pending = st.session_state.pending_action
+    if pending:
+        st.session_state.pending_action = None
+        kind, text = pending
+        with chat_container:
+            if kind == "analysis":
+                generate_analysis()
+            else:
+                handle_user_message(text)
+
+def request_email_summary(email):
+    """Store the submitted address and email the conversation if there is one"""
+    st.session_state.user_email = email
+    if st.session_state.conversation:
+        send_email_via_gmail()
+    else:
+        st.warning("No conversation to send")
 
 def show_enhanced_footer():
     """Enhanced footer with clear actions"""
     st.markdown("---")
     
     if st.session_state.mobile_view:
-        # Stacked buttons for mobile
-        col1, col2 = st.columns(2)
-        with col1:
-            if st.button("🔄 New Session", use_container_width=True):
-                clear_session_data()
-        with col2:
-            if st.button("📧 Email Summary", use_container_width=True):
-                if st.session_state.conversation:
-                    send_email_via_gmail()
-                else:
-                    st.warning("No conversation to send")
+        if st.button("🔄 New Session", use_container_width=True):
+            clear_session_data()
         
-        # Email input below buttons
-        st.session_state.user_email = st.text_input(
-            "Email address for summary:",
-            placeholder="your.email@example.com",
-            value=st.session_state.user_email,
-            key="mobile_email_input"
-        )
+        # Email input and its button submit together, so typing the
+        # address doesn't rerun the whole app
+        with st.form("mobile_email_form"):
+            email = st.text_input(
+                "Email address for summary:",
+                placeholder="your.email@example.com",
+                value=st.session_state.user_email,
+                key="mobile_email_input"
+            )
+            email_submitted = st.form_submit_button("📧 Email Summary", use_container_width=True)
+        
+        if email_submitted:
+            request_email_summary(email)
     else:
         # Horizontal layout for desktop
         col1, col2, col3 = st.columns([1, 2, 1])
@@ -401,43 +636,139 @@ def show_enhanced_footer():
             if st.button("🔄 New Session", use_container_width=True):
                 clear_session_data()
         with col2:
-            email_col1, email_col2 = st.columns([3, 1])
-            with email_col1:
-                st.session_state.user_email = st.text_input(
-                    "Email for summary:",
-                    placeholder="your.email@example.com",
-                    value=st.session_state.user_email,
-                    label_visibility="collapsed"
-                )
-            with email_col2:
-                if st.button("Send", use_container_width=True, type="secondary"):
-                    if st.session_state.conversation:
-                        send_email_via_gmail()
-                    else:
-                        st.warning("No conversation to send")
+            with st.form("email_form"):
+                email_col1, email_col2 = st.columns([3, 1])
+                with email_col1:
+                    email = st.text_input(
+                        "Email for summary:",
+                        placeholder="your.email@example.com",
+                        value=st.session_state.user_email,
+                        label_visibility="collapsed"
+                    )
+                with email_col2:
+                    email_submitted = st.form_submit_button("Send", use_container_width=True, type="secondary")
+            
+            if email_submitted:
+                request_email_summary(email)
         with col3:
             st.caption(f"Messages: {len(st.session_state.conversation)}")
 
+# ========== OPENAI RESPONSE CACHE ==========
+def prompt_cache_key(model, messages):
+    """Stable hash of a chat request with whitespace-normalized content"""
+    normalized = [{"role": msg["role"], "content": " ".join(msg["content"].split())}
+                  for msg in messages]
+    payload = json.dumps({"model": model, "messages": normalized}, sort_keys=True)
+    return hashlib.blake2b(payload.encode("utf-8")).hexdigest()
+
+RESPONSE_CACHE_TTL = 3600  # seconds
+RESPONSE_CACHE_MAX_ENTRIES = 256
+OPENAI_MAX_ATTEMPTS = 3
+OPENAI_MAX_CONCURRENT = 4
+OPENAI_SLOT_TIMEOUT = 120  # seconds to wait for a free slot before giving up
+
+@st.cache_resource
+def get_openai_semaphore():
+    """Caps in-flight OpenAI requests across all sessions in this process"""
+    return threading.BoundedSemaphore(OPENAI_MAX_CONCURRENT)
+
+def with_retry(slot, fn, *args, **kwargs):
+    """Call fn holding slot, retrying rate limits and server errors with backoff"""
+    # On success the caller still holds slot and must release it once the
+    # response has been consumed; failed attempts release it before sleeping
+    for attempt in range(OPENAI_MAX_ATTEMPTS):
+        if not slot.acquire(timeout=OPENAI_SLOT_TIMEOUT):
+            raise TimeoutError("Too many requests in progress, please try again shortly")
+        try:
+            return fn(*args, **kwargs)
+        except (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError):
+            slot.release()
+            if attempt == OPENAI_MAX_ATTEMPTS - 1:
+                raise
+        except BaseException:
+            slot.release()
+            raise
+        time.sleep(min(30, 2 ** attempt))
+
+@st.cache_resource
+def get_response_cache():
+    """Process-wide store of (timestamp, reply) keyed by prompt hash, and its lock"""
+    return {"entries": {}, "lock": threading.Lock()}
+
+def stream_text(stream):
+    """Yield the text deltas of a streamed chat completion"""
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+def chat_completion(messages, spinner_text="🤖 Thinking...", model=OPENAI_MODEL, cache_hint=None):
+    """Stream an assistant reply into the page, served from cache for repeated prompts"""
+    key = prompt_cache_key(model, messages)
+    cache = get_response_cache()
+    
+    with cache["lock"]:
+        cached = cache["entries"].get(key)
+    if cached and time.time() - cached[0] < RESPONSE_CACHE_TTL:
+        st.markdown(cached[1])
+        return cached[1]
+    
+    # The slot covers generation, not just the request headers
+    # Any UI update, including the spinner's exit, can raise Streamlit's
+    # rerun/stop exceptions, so the slot is guarded from the moment it is held
+    slot = get_openai_semaphore()
+    stream = None
+    try:
+        with st.spinner(spinner_text):
+            stream = with_retry(
+                slot,
+                get_openai_client().chat.completions.create,
+                model=model,
+                messages=messages,
+                stream=True,
+                # Routes requests sharing a report prefix to the same provider prompt cache
+                extra_body={"prompt_cache_key": cache_hint} if cache_hint else None
+            )
+        reply = st.write_stream(stream_text(stream))
+    finally:
+        if stream is not None:
+            stream.close()
+            slot.release()
+    
+    # Write-through, dropping entries that have outlived the TTL and then
+    # the oldest ones beyond the size cap (dicts keep insertion order)
+    now = time.time()
+    with cache["lock"]:
+        entries = cache["entries"]
+        for stale in [k for k, (ts, _) in entries.items() if now - ts >= RESPONSE_CACHE_TTL]:
+            del entries[stale]
+        entries.pop(key, None)
+        entries[key] = (now, reply)
+        while len(entries) > RESPONSE_CACHE_MAX_ENTRIES:
+            del entries[next(iter(entries))]
+    return reply
+
 # ========== CORE FUNCTIONS (Keep your existing ones) ==========
 def generate_analysis():
     """Your existing generate_analysis function"""
-    with st.spinner("🤖 Analyzing your medical documents..."):
+    with st.chat_message("assistant", avatar="🤖"):
         try:
-            prompt = f"""Based on the following medical report content, please provide:
-1. Concise health summary
-2. 5 suggested questions for your cardiologist/primary doctor (limit to 5 questions maximum)
-3. Professional dietitian advice based on health report
-
-Medical report content:
-{st.session_state.ocr_text}
-
-Please respond in a professional, caring manner. Keep the questions limited to 5 maximum to avoid overwhelming the patient."""
-
-            response = openai.chat.completions.create(
-                model="gpt-5-mini",
-                messages=[{"role": "user", "content": prompt}]
+            # Static instructions first so every analysis shares a cacheable prefix;
+            # kept so follow-ups resend the exact same prefix for this report
+            report = st.session_state.ocr_text
+            st.session_state.report_context = [
+                {"role": "system", "content": SYSTEM_INSTRUCTIONS},
+                {"role": "user", "content": REPORT_MESSAGE_TEMPLATE.format(report=report)}
+            ]
+            st.session_state.report_cache_key = hashlib.blake2b(
+                report.encode("utf-8"), digest_size=16
+            ).hexdigest()
+
+            # The three-part task follows the report, so only this call asks for it
+            ai_output = chat_completion(
+                st.session_state.report_context + [ANALYSIS_REQUEST],
+                spinner_text="🤖 Analyzing your medical documents...",
+                cache_hint=st.session_state.report_cache_key
             )
-            ai_output = response.choices[0].message.content
             
             st.session_state.conversation.append({
                 "role": "assistant", 
@@ -451,21 +782,41 @@ Please respond in a professional, caring manner. Keep the questions limited to 5
         except Exception as e:
             st.error(f"❌ Analysis failed: {e}")
 
+# Recent follow-up turns (a question and its answer) sent with each question,
+# counting the new one; the report and initial analysis are always kept so
+# the cached prefix stays intact
+LAST_N_TURNS = 3
+
+def build_followup_messages(conversation):
+    """Report prefix, initial analysis, then a window of the latest turns"""
+    # Anchor on the latest analysis: Generate can run again on a new report,
+    # and report_context always holds the report that analysis was about
+    analyses = [i for i, msg in enumerate(conversation) if msg.get("type") == "initial_analysis"]
+    head = [conversation[analyses[-1]]] if analyses else []
+    rest = conversation[analyses[-1] + 1:] if analyses else conversation
+    # Start the window on a question, never on an answer whose question was cut
+    turn_starts = [i for i, msg in enumerate(rest) if msg["role"] == "user"][-LAST_N_TURNS:]
+    recent = rest[turn_starts[0]:] if turn_starts else rest
+    # Replaying the analysis request keeps the analysis call's prefix intact
+    prefix = st.session_state.report_context + ([ANALYSIS_REQUEST] if head else [])
+    return prefix + [
+        {"role": msg["role"], "content": msg["content"]}
+        for msg in head + recent
+    ]
+
 def handle_user_message(user_input):
     """Your existing handle_user_message function"""
     st.session_state.conversation.append({"role": "user", "content": user_input})
     st.session_state.last_activity = datetime.now()
     
-    with st.spinner("🤖 Thinking..."):
+    with st.chat_message("user", avatar="👤"):
+        st.markdown(user_input)
+    
+    with st.chat_message("assistant", avatar="🤖"):
         try:
-            messages = [{"role": msg["role"], "content": msg["content"]} 
-                       for msg in st.session_state.conversation]
+            messages = build_followup_messages(st.session_state.conversation)
             
-            response = openai.chat.completions.create(
-                model="gpt-5-mini",
-                messages=messages
-            )
-            ai_reply = response.choices[0].message.content
+            ai_reply = chat_completion(messages, cache_hint=st.session_state.report_cache_key)
             st.session_state.conversation.append({"role": "assistant", "content": ai_reply})
             st.session_state.last_activity = datetime.now()
             st.rerun()
@@ -474,26 +825,8 @@ def handle_user_message(user_input):
             st.error(f"❌ Failed to generate response: {e}")
 
 def handle_suggested_question(question):
-    """Your existing handle_suggested_question function"""
-    st.session_state.conversation.append({"role": "user", "content": question})
-    st.session_state.last_activity = datetime.now()
-    
-    with st.spinner("🤖 Thinking..."):
-        try:
-            messages = [{"role": msg["role"], "content": msg["content"]} 
-                       for msg in st.session_state.conversation]
-            
-            response = openai.chat.completions.create(
-                model="gpt-5-mini",
-                messages=messages
-            )
-            ai_reply = response.choices[0].message.content
-            st.session_state.conversation.append({"role": "assistant", "content": ai_reply})
-            st.session_state.last_activity = datetime.now()
-            st.rerun()
-            
-        except Exception as e:
-            st.error(f"❌ Failed to generate response: {e}")
+    """Queue a suggested question to be answered through the regular chat path"""
+    st.session_state.pending_action = ("question", question)
 
 def clear_session_data():
     """Clear all session data"""
@@ -501,6 +834,27 @@ def clear_session_data():
         del st.session_state[key]
     st.rerun()
 
+# Shared system message for the analysis and every follow-up: role and tone
+# only, so follow-up answers aren't pushed into the analysis format. Fixed
+# text first and only the OCR text varies, so the provider can reuse the
+# cached prefix
+SYSTEM_INSTRUCTIONS = """You are a caring assistant helping a patient understand the medical report content they have provided.
+
+Please respond in a professional, caring manner, in plain language, and answer the patient's question directly."""
+
+REPORT_MESSAGE_TEMPLATE = """Medical report content:
+{report}"""
+
+# Initial analysis task, sent after the report in the analysis call only
+ANALYSIS_INSTRUCTIONS = """Based on the medical report content provided above, please provide:
+1. Concise health summary
+2. 5 suggested questions for your cardiologist/primary doctor (limit to 5 questions maximum)
+3. Professional dietitian advice based on health report
+
+Keep the questions limited to 5 maximum to avoid overwhelming the patient."""
+
+ANALYSIS_REQUEST = {"role": "user", "content": ANALYSIS_INSTRUCTIONS}
+
 # Suggested questions
 SUGGESTED_QUESTIONS = [
     "Can you explain my test results in simple terms?",